@@ -2,11 +2,14 @@
 import argparse
 import logging
 import pathlib
-import array
+import math
+from collections import deque
 from enum import Enum
 
 from typing import Optional, override
 
+import numpy as np
+
 from parasnake.ps_config import PSConfiguration
 from parasnake.ps_node import PSNode
 from parasnake.ps_server import PSServer
@@ -18,7 +21,7 @@ logger = logging.getLogger(__name__)
 
 class MandelInfo:
     def __init__(self, c_start: complex = -2.0-1.5j, c_end: complex = 1.0+1.5j,
-            width: int = 2048, height: int = 2048, max_iteration: int = 2048):
+            width: int = 2048, height: int = 2048, max_iteration: int = 2048, rows_per_unit: int = 16):
         self.c_start: complex = c_start
         self.c_end: complex = c_end
         self.width: int = width
@@ -26,6 +29,147 @@ class MandelInfo:
         self.re_step: float = (c_end.real - c_start.real) / float(width)
         self.im_step: float = (c_end.imag - c_start.imag) / float(height)
         self.max_iteration: int = max_iteration
+        # Number of rows that are sent to a node in one go:
+        self.rows_per_unit: int = rows_per_unit
+        # Smallest type that holds all iteration counts, less data to send and to store:
+        self.dtype: type = np.uint16 if max_iteration < (1 << 16) else np.uint32
+
+
+def _abs2(z: np.ndarray) -> np.ndarray:
+    """
+    Squared magnitude of the complex values, avoids the square root in abs().
+    """
+
+    result = np.square(z.real)
+    result += np.square(z.imag)
+    return result
+
+
+def _mandel_row_numpy(cr: np.ndarray, ci: np.ndarray, max_iter: int, out: np.ndarray) -> np.ndarray:
+    """
+    Vectorized escape time kernel: each step advances all pixels that have not escaped yet.
+    Like the Numba version it computes one row for each value in ci and writes them to out.
+    """
+
+    ci = np.asarray(ci, dtype=np.float64)
+    c = np.ascontiguousarray((cr + (1j * ci[..., np.newaxis])).ravel(), dtype=np.complex128)
+    z = c.copy()
+    count = np.zeros(c.shape[0], np.uint32)
+
+    # Points in the main cardioid or in the period-2 bulb never escape:
+    q = np.square(c.real - 0.25) + np.square(c.imag)
+    inside = (q * (q + (c.real - 0.25)) < 0.25 * np.square(c.imag)) | \
+        (np.square(c.real + 1.0) + np.square(c.imag) < 0.0625)
+    count[inside] = max_iter
+
+    # Only keep the pixels that are still active:
+    index = np.flatnonzero(np.less(_abs2(z), 4.0) & ~inside)
+    z = z[index]
+    c = c[index]
+
+    for _ in range(max_iter):
+        if index.size == 0:
+            break
+
+        np.square(z, out=z)
+        np.add(z, c, out=z)
+        count[index] += 1
+
+        active = np.less(_abs2(z), 4.0)
+        index = index[active]
+        z = z[active]
+        c = c[active]
+
+    out[...] = count.reshape(ci.shape + cr.shape)
+    return out
+
+
+# Number of pixels that are iterated in lock step, so that the compiler can use SIMD instructions:
+LANES: int = 8
+
+
+try:
+    from numba import guvectorize
+
+    # NumPy casts the result to the type of the output array, the counts always fit:
+    @guvectorize(["void(float64[:], float64, int64, uint32[:])"], "(n),(),()->(n)",
+        target="parallel", cache=True)
+    def _mandel_row(cr: np.ndarray, ci: float, max_iter: int, out: np.ndarray):
+        width = cr.shape[0]
+        c = np.zeros(LANES)
+        zr = np.zeros(LANES)
+        zi = np.zeros(LANES)
+        count = np.zeros(LANES, np.uint32)
+
+        for start in range(0, width, LANES):
+            size = min(LANES, width - start)
+
+            for k in range(LANES):
+                c[k] = cr[start + k] if k < size else 0.0
+                zr[k] = c[k]
+                zi[k] = ci
+                count[k] = 0
+
+                # Points in the main cardioid or in the period-2 bulb never escape,
+                # lanes past the end of the row are not used:
+                q = ((c[k] - 0.25) * (c[k] - 0.25)) + (ci * ci)
+                if (k >= size) or (q * (q + (c[k] - 0.25)) < 0.25 * ci * ci) or \
+                        (((c[k] + 1.0) * (c[k] + 1.0)) + (ci * ci) < 0.0625):
+                    count[k] = max_iter
+
+            for i in range(max_iter):
+                active = 0
+
+                for k in range(LANES):
+                    zr2 = zr[k] * zr[k]
+                    zi2 = zi[k] * zi[k]
+                    # Once a lane has escaped it stays inactive and keeps its count:
+                    inside = (count[k] == i) and (zr2 + zi2 < 4.0)
+                    new_zi = (2.0 * zr[k] * zi[k]) + ci
+                    zr[k] = (zr2 - zi2 + c[k]) if inside else zr[k]
+                    zi[k] = new_zi if inside else zi[k]
+                    count[k] += inside
+                    active += inside
+
+                if active == 0:
+                    break
+
+            for k in range(size):
+                out[start + k] = count[k]
+except ImportError:
+    # Numba is optional, use the NumPy version instead:
+    _mandel_row = _mandel_row_numpy
+
+try:
+    from numba import cuda
+
+    @cuda.jit(cache=True)
+    def _mandel_band_cuda(cr, ci, max_iter, out):
+        # One GPU thread for each pixel of the band:
+        x, y = cuda.grid(2)  # type: ignore[call-arg, var-annotated]
+
+        if (y < out.shape[0]) and (x < out.shape[1]):
+            zr = cr[x]
+            zi = ci[y]
+            i = 0
+
+            while (i < max_iter) and ((zr * zr) + (zi * zi) < 4.0):
+                zr, zi = (zr * zr) - (zi * zi) + cr[x], (2.0 * zr * zi) + ci[y]
+                i += 1
+
+            out[y, x] = i
+except ImportError:
+    cuda = None  # type: ignore[assignment]
+
+# Threads per block (x, y) for the GPU kernel:
+CUDA_BLOCK: tuple[int, int] = (32, 8)
+
+
+# Scratch file for the iteration counts while the image is computed:
+RAW_IMAGE_FILE: str = "mandel_image.raw"
+
+# Number of image rows that are converted to RGB in one go when saving:
+SAVE_ROWS: int = 256
 
 
 class RowStatus(Enum):
@@ -42,43 +186,80 @@ class MandelNode(PSNode):
     def ps_init(self, data: MandelInfo):
         self.mandel_info: MandelInfo = data
 
-    @override
-    def ps_process_data(self, data: int) -> array.array:
-        width: int = self.mandel_info.width
-        elems = (0 for _ in range(width))
-        line = array.array("L", elems)
+        # The real part of c is the same for every row:
+        self.c_real: np.ndarray = data.c_start.real + (data.re_step * np.arange(data.width, dtype=np.float64))
 
-        step_x: float = self.mandel_info.re_step
+        # Use the GPU if there is one. The buffers are allocated once and reused for every band:
+        self.use_cuda: bool = (cuda is not None) and cuda.is_available()
+
+        if self.use_cuda:
+            self.cuda_c_real = cuda.to_device(self.c_real)
+            self.cuda_out = cuda.device_array((data.rows_per_unit, data.width), dtype=data.dtype)
+            self.host_out = cuda.pinned_array((data.rows_per_unit, data.width), dtype=data.dtype)
+
+            # The GPU kernel is compiled on the first call, do that now and not in the first work unit:
+            self.process_data_cuda(np.array([data.c_start.imag]))
+
+    @override
+    def ps_process_data(self, data: tuple[int, int]) -> tuple[int, int, bytes]:
+        start, count = data
         step_y: float = self.mandel_info.im_step
         c_start: complex = self.mandel_info.c_start
-        c_y: float = c_start.imag + (step_y * data)
+        c_imag = c_start.imag + (step_y * np.arange(start, start + count, dtype=np.float64))
+
+        # The rows are sent back with the result, so the server puts them in the right place
+        # even if the result arrives twice after a reconnect:
+        if self.use_cuda:
+            return (start, count, self.process_data_cuda(c_imag))
 
-        for x in range(width):
-            c_x: float = c_start.real + (step_x * x)
-            c = complex(c_x, c_y)
-            z = c
-            iter = 0
+        # One row for each imaginary value:
+        rows: np.ndarray = np.empty((count, self.mandel_info.width), dtype=self.mandel_info.dtype)
+        _mandel_row(self.c_real, c_imag, np.int64(self.mandel_info.max_iteration), rows)
 
-            while (abs(z) < 2.0) and (iter < self.mandel_info.max_iteration):
-                z = c + (z * z)
-                iter += 1
+        # Raw bytes are cheaper to pickle than an array:
+        return (start, count, rows.tobytes())
 
-            line[x] = iter
+    def process_data_cuda(self, c_imag: np.ndarray) -> bytes:
+        count: int = c_imag.shape[0]
+        width: int = self.mandel_info.width
+        blocks = ((width + CUDA_BLOCK[0] - 1) // CUDA_BLOCK[0], (count + CUDA_BLOCK[1] - 1) // CUDA_BLOCK[1])
 
-        return line
+        out = self.cuda_out[:count]
+        _mandel_band_cuda[blocks, CUDA_BLOCK](self.cuda_c_real, cuda.to_device(c_imag),
+            self.mandel_info.max_iteration, out)
+        out.copy_to_host(self.host_out[:count])
+
+        return self.host_out[:count].tobytes()
 
 
 class MandelServer(PSServer):
     def __init__(self, config: PSConfiguration, mandel_info: MandelInfo):
         super().__init__(config)
         self.mandel_info: MandelInfo = mandel_info
-        self.node_id_row: dict[PSNodeId, int] = {}
+        self.node_id_rows: dict[PSNodeId, tuple[int, int]] = {}
 
-        size = mandel_info.width * mandel_info.height
-        elems = (0 for _ in range(size))
-        self.mandel_image = array.array("L", elems)
+        # Backed by a file, so big images do not have to fit into RAM:
+        self.mandel_image: np.memmap = np.memmap(RAW_IMAGE_FILE, dtype=mandel_info.dtype, mode="w+",
+            shape=(mandel_info.height, mandel_info.width))
 
         self.processed_rows = [RowStatus.Empty for _ in range(mandel_info.height)]
+        self.rows_done: int = 0
+
+        # The set is symmetric to the real axis. If the image is too, row y and row (height - y)
+        # are the same and only the upper half has to be computed:
+        self.symmetric: bool = math.isclose(mandel_info.c_start.imag, -mandel_info.c_end.imag)
+
+        if self.symmetric:
+            num_rows: int = (mandel_info.height // 2) + 1
+        else:
+            num_rows = mandel_info.height
+
+        # Bands of rows (start, count) that still have to be sent to a node:
+        self.pending_rows: deque[tuple[int, int]] = deque()
+        step: int = mandel_info.rows_per_unit
+
+        for start in range(0, num_rows, step):
+            self.pending_rows.append((start, min(step, num_rows - start)))
 
     @override
     def ps_get_init_data(self, node_id: PSNodeId) -> MandelInfo:
@@ -86,58 +267,90 @@ class MandelServer(PSServer):
 
     @override
     def ps_is_job_done(self) -> bool:
-        for status in self.processed_rows:
-            if status != RowStatus.Done:
-                return False
-
-        return True
+        return self.rows_done == self.mandel_info.height
 
     @override
     def ps_save_data(self) -> None:
         width: int = self.mandel_info.width
         height: int = self.mandel_info.height
+        img = self.mandel_image
+
+        with open("mandel_image.ppm", "wb") as f:
+            f.write(f"P6\n{width} {height}\n255\n".encode())
+
+            # Convert a few rows at a time, so that the whole image never has to be in RAM:
+            for start in range(0, height, SAVE_ROWS):
+                rows = img[start:start + SAVE_ROWS]
 
-        with open("mandel_image.ppm", "w") as f:
-            f.write("P3\n")
-            f.write(f"{width} {height}\n")
-            f.write("255\n")
-
-            for y in range(height):
-                for x in range(width):
-                    val: int = self.mandel_image[(y * width) + x]
-                    if val < self.mandel_info.max_iteration:
-                        color_value = (val % 16) * 16
-                        f.write(f"255 {color_value} 0 ")
-                    else:
-                        f.write("0 0 0 ")
-                f.write("\n")
+                # Escaped points are orange to yellow, points inside the set are black:
+                escaped = rows < self.mandel_info.max_iteration
+                rgb = np.zeros(rows.shape + (3,), dtype=np.uint8)
+                rgb[..., 0] = np.where(escaped, 255, 0)
+                rgb[..., 1] = np.where(escaped, (rows % 16) * 16, 0)
+                f.write(rgb.tobytes())
+
+        # The raw iteration counts are not needed any more. Release all views of the memmap
+        # first, an open mapping can't be removed on Windows:
+        del rows, escaped, rgb, img
+        del self.mandel_image
+        pathlib.Path(RAW_IMAGE_FILE).unlink(missing_ok=True)
 
     @override
     def ps_node_timeout(self, node_id: PSNodeId) -> None:
-        if node_id in self.node_id_row:
-            row = self.node_id_row[node_id]
-            self.processed_rows[row] = RowStatus.Empty
-            del self.node_id_row[node_id]
+        if node_id in self.node_id_rows:
+            start, count = self.node_id_rows.pop(node_id)
+            self.processed_rows[start:start + count] = [RowStatus.Empty] * count
+            # Hand them out again before all the other rows:
+            self.pending_rows.appendleft((start, count))
 
     @override
-    def ps_get_new_data(self, node_id: PSNodeId) -> Optional[int]:
-        for i, status in enumerate(self.processed_rows):
-            if status == RowStatus.Empty:
-                self.node_id_row[node_id] = i
-                self.processed_rows[i] = RowStatus.Pending
-                return i
+    def ps_get_new_data(self, node_id: PSNodeId) -> Optional[tuple[int, int]]:
+        # The node may ask again after a reconnect, give it the same rows:
+        if node_id in self.node_id_rows:
+            return self.node_id_rows[node_id]
+
+        # Skip rows that a node, which was timed out, has finished after all:
+        while self.pending_rows and self.processed_rows[self.pending_rows[0][0]] == RowStatus.Done:
+            self.pending_rows.popleft()
+
+        if not self.pending_rows:
+            return None
 
-        return None
+        start, count = self.pending_rows.popleft()
+        self.node_id_rows[node_id] = (start, count)
+        self.processed_rows[start:start + count] = [RowStatus.Pending] * count
+        return (start, count)
 
     @override
-    def ps_process_result(self, node_id: PSNodeId, result: array.array):
-        row: int = self.node_id_row[node_id]
-        offset: int = (row * self.mandel_info.width)
+    def ps_process_result(self, node_id: PSNodeId, result: tuple[int, int, bytes]):
+        start, count, data = result
+
+        # The rows are no longer assigned to this node, so a later timeout doesn't reset them:
+        if self.node_id_rows.get(node_id) == (start, count):
+            del self.node_id_rows[node_id]
+
+        if self.processed_rows[start] == RowStatus.Done:
+            # Result has already been sent before a reconnect.
+            return
+
+        rows: np.ndarray = np.frombuffer(data, dtype=self.mandel_info.dtype).reshape(count, self.mandel_info.width)
+        self.mandel_image[start:start + count] = rows
+
+        for row in range(start, start + count):
+            self.mark_row_done(row)
+
+            if self.symmetric:
+                mirror: int = self.mandel_info.height - row
 
-        for x in range(self.mandel_info.width):
-            self.mandel_image[offset + x] = result[x]
+                # Row 0 has no mirror row and the middle row is its own mirror:
+                if row > 0 and mirror != row:
+                    self.mandel_image[mirror] = self.mandel_image[row]
+                    self.mark_row_done(mirror)
 
-        self.processed_rows[row] = RowStatus.Done
+    def mark_row_done(self, row: int):
+        if self.processed_rows[row] != RowStatus.Done:
+            self.processed_rows[row] = RowStatus.Done
+            self.rows_done += 1
 
 
 def run_server(config: PSConfiguration):
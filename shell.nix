@@ -7,6 +7,8 @@
         flake8
         ipython
         mypy
+        numba
+        numpy
         ]))
       pyright
       ruff
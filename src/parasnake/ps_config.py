@@ -16,9 +16,15 @@ logger = logging.getLogger(__name__)
 
 
 class PSConfiguration:
+    # Fixed set of options, no per instance dict needed:
+    __slots__ = ("server_address", "server_port", "heartbeat_timeout", "secret_key", "quit_counter", "use_threads",
+                 "worker_threads", "max_concurrent", "socket_buffer_size")
+
     def __init__(self, secret_key: str):
         self.server_address: str = "127.0.0.1"
         self.server_port: int = 3100
+        # In seconds. The nodes send a heartbeat after heartbeat_timeout / 2 without any other
+        # message, the server closes idle connections and times nodes out after 2 * heartbeat_timeout:
         self.heartbeat_timeout: int = 60 * 5
 
         assert len(secret_key) == 32, f"Key must be exactly 32 bytes long: {secret_key}"
@@ -26,6 +32,22 @@ class PSConfiguration:
 
         self.quit_counter: int = 10
 
+        # Run the user callbacks of the server in separate threads, set to False if they
+        # are fast and never block to save the thread hop:
+        self.use_threads: bool = True
+
+        # Number of threads for the user callbacks of the server. They all share one lock,
+        # so more threads only help if the callbacks are overridden to not use it:
+        self.worker_threads: int = 1
+
+        # Maximum number of node messages the server handles at the same time,
+        # the others wait until one is done:
+        self.max_concurrent: int = 256
+
+        # Size of the socket send and receive buffers in bytes, 0 = keep the OS default.
+        # On Linux setting it turns off the automatic buffer tuning, so only set it if needed:
+        self.socket_buffer_size: int = 0
+
     @staticmethod
     def from_json(file_name) -> Any:
         """
@@ -59,5 +81,21 @@ class PSConfiguration:
             config.quit_counter = data["quit_counter"]
             assert config.quit_counter > 0, f"Quit counter must be greater than 0: {config.quit_counter}"
 
+        if "use_threads" in data:
+            config.use_threads = data["use_threads"]
+
+        if "worker_threads" in data:
+            config.worker_threads = data["worker_threads"]
+            assert config.worker_threads > 0, f"Worker threads must be greater than 0: {config.worker_threads}"
+
+        if "max_concurrent" in data:
+            config.max_concurrent = data["max_concurrent"]
+            assert config.max_concurrent > 0, f"Max concurrent must be greater than 0: {config.max_concurrent}"
+
+        if "socket_buffer_size" in data:
+            config.socket_buffer_size = data["socket_buffer_size"]
+            assert config.socket_buffer_size >= 0, \
+                f"Socket buffer size must not be negative: {config.socket_buffer_size}"
+
         return config
 
@@ -0,0 +1,36 @@
+# This file is part of Parasnake, a distributed number crunching library for Python
+# written by Willi Kappler, MIT license.
+#
+# See: https://github.com/willi-kappler/parasnake
+
+"""
+This module selects the asyncio event loop for the server and the node.
+If uvloop is installed (pip install parasnake[uvloop]) it is used,
+otherwise the default asyncio event loop.
+"""
+
+# Python std modules:
+import asyncio
+import importlib
+import importlib.util
+import logging
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def ps_loop_factory() -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """
+    Returns the factory for the event loop that is passed to asyncio.run().
+
+    :return: uvloop.new_event_loop if uvloop is installed, None (= default event loop) otherwise.
+    :rtype: Optional[Callable[[], asyncio.AbstractEventLoop]]
+    """
+
+    # uvloop is optional, look it up at runtime so that type checkers don't need it:
+    if importlib.util.find_spec("uvloop") is None:
+        logger.debug("Using default asyncio event loop.")
+        return None
+    else:
+        logger.debug("Using uvloop event loop.")
+        return importlib.import_module("uvloop").new_event_loop
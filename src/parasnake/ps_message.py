@@ -9,13 +9,19 @@ This module defines all the messages and how to decode and encode them.
 
 
 # Python std modules:
-from typing import Any
+from typing import Any, Iterator
 from enum import Enum
+import asyncio
+import base64
+import contextlib
+import functools
+import gc
+import os
 import pickle
-import lzma
+import zlib
 
 # External modules:
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 # Local modules:
 from parasnake.ps_nodeid import PSNodeId
@@ -54,6 +60,77 @@ class PSMessageType(Enum):
     Quit = 11
 
 
+# Messages smaller than this (in bytes) are not compressed,
+# for tiny control messages the codec overhead is bigger than the gain.
+COMPRESSION_THRESHOLD: int = 256
+
+# Fast zlib level, most messages are small or already dense.
+COMPRESSION_LEVEL: int = 1
+
+# First byte of the plain text, marks if the payload is compressed or not.
+FLAG_RAW: int = 0
+FLAG_COMPRESSED: int = 1
+
+# Size of the random nonce in front of every encrypted message.
+NONCE_SIZE: int = 12
+
+# Every message on the wire is prefixed with its length (big endian).
+FRAME_HEADER_SIZE: int = 4
+
+# Upper limit for the size of one message, anything bigger is neither sent nor read.
+MAX_MSG_BYTES: int = 64 * 1024 * 1024
+
+# Encoded messages without any payload, keyed by message type and secret key.
+_STATIC_MSG_CACHE: dict[tuple[PSMessageType, bytes], bytes] = {}
+
+
+@functools.lru_cache(maxsize=8)
+def _aead(secret_key: bytes) -> AESGCM:
+    """
+    Creating the AES-GCM instance decodes the key and sets up the crypto context,
+    so do that only once per key.
+    """
+
+    return AESGCM(base64.urlsafe_b64decode(secret_key))
+
+
+@contextlib.contextmanager
+def _no_gc() -> Iterator[None]:
+    """
+    Pauses the garbage collector while (un)pickling, which creates lots of
+    short lived objects. Does nothing if the garbage collector is already disabled,
+    so nested or concurrent use does not turn it back on too early.
+    """
+
+    if gc.isenabled():
+        gc.disable()
+        try:
+            yield
+        finally:
+            gc.enable()
+    else:
+        yield
+
+
+def serialize_message(message: Any) -> bytes:
+    """
+    Serializes and (if big enough) compresses a message.
+    This is the plain text that will be encrypted.
+
+    :param message: The message to serialize.
+    :return: The serialized message.
+    :rtype: bytes
+    """
+
+    with _no_gc():
+        msg_ser = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+    if len(msg_ser) < COMPRESSION_THRESHOLD:
+        return bytes((FLAG_RAW,)) + msg_ser
+    else:
+        return bytes((FLAG_COMPRESSED,)) + zlib.compress(msg_ser, COMPRESSION_LEVEL)
+
+
 def encode_message(message: Any, secret_key: bytes) -> bytes:
     """
     Encodes a message with the given key..
@@ -64,13 +141,42 @@ def encode_message(message: Any, secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    f = Fernet(secret_key)
+    return encrypt_message(serialize_message(message), secret_key)
+
+
+def encrypt_message(msg_ser: bytes, secret_key: bytes) -> bytes:
+    """
+    Encrypts and authenticates an already serialized message with the given key (AES-GCM).
+    Each call uses a new random nonce, which is put in front of the encrypted message.
+
+    :param msg_ser: The serialized message, see serialize_message().
+    :param secret_key: A secret key that is known by the server and client.
+    :return: The encoded message.
+    :rtype: bytes
+    """
+
+    nonce = os.urandom(NONCE_SIZE)
+
+    return nonce + _aead(secret_key).encrypt(nonce, msg_ser, None)
+
+
+def encode_static_message(msg_type: PSMessageType, secret_key: bytes) -> bytes:
+    """
+    Encodes a message that only consists of the message type.
+    Since these messages never change, they are encoded only once per key.
+
+    :param msg_type: The type of the message to encode.
+    :param secret_key: A secret key that is known by the server and client.
+    :return: The encoded message.
+    :rtype: bytes
+    """
+
+    cache_key = (msg_type, secret_key)
 
-    msg_ser = pickle.dumps(message)
-    msg_cmp = lzma.compress(msg_ser)
-    msg_enc = f.encrypt(msg_cmp)
+    if cache_key not in _STATIC_MSG_CACHE:
+        _STATIC_MSG_CACHE[cache_key] = encode_message(msg_type, secret_key)
 
-    return msg_enc
+    return _STATIC_MSG_CACHE[cache_key]
 
 
 def decode_message(message: bytes, secret_key: bytes) -> Any:
@@ -83,15 +189,90 @@ def decode_message(message: bytes, secret_key: bytes) -> Any:
     :rtype: Any
     """
 
-    f = Fernet(secret_key)
+    # Raises cryptography.exceptions.InvalidTag if the message has been tampered with
+    # or was encoded with a different key.
+    msg_cmp = _aead(secret_key).decrypt(message[:NONCE_SIZE], memoryview(message)[NONCE_SIZE:], None)
+
+    # Skip the flag byte without copying the (maybe large) rest of the message:
+    payload = memoryview(msg_cmp)[1:]
 
-    msg_cmp = f.decrypt(message)
-    msg_ser = lzma.decompress(msg_cmp)
-    obj = pickle.loads(msg_ser)
+    msg_ser: bytes | memoryview
+
+    if msg_cmp[0] == FLAG_COMPRESSED:
+        msg_ser = zlib.decompress(payload)
+    else:
+        msg_ser = payload
+
+    with _no_gc():
+        obj = pickle.loads(msg_ser)
 
     return obj
 
 
+def frame_header(message: bytes) -> bytes:
+    """
+    Returns the length prefix for the given encoded message.
+    Use it together with writer.writelines() to avoid copying the message.
+    Raises ValueError if the message is bigger than MAX_MSG_BYTES, since the
+    other side would reject it anyway.
+
+    :param message: The encoded message.
+    :return: The length prefix.
+    :rtype: bytes
+    """
+
+    size = len(message)
+
+    if size > MAX_MSG_BYTES:
+        raise ValueError(f"Message too big to send: {size} bytes, the limit is {MAX_MSG_BYTES} bytes")
+
+    return size.to_bytes(FRAME_HEADER_SIZE, "big")
+
+
+def frame_message(message: bytes) -> bytes:
+    """
+    Prefixes an encoded message with its length, so that several messages
+    can be sent over the same connection.
+
+    :param message: The encoded message.
+    :return: The message with the length prefix.
+    :rtype: bytes
+    """
+
+    return frame_header(message) + message
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    """
+    Reads one length prefixed message from the given stream.
+    Raises asyncio.IncompleteReadError if the connection is closed before
+    the whole message has been received and ValueError if the message is
+    bigger than MAX_MSG_BYTES.
+
+    :param reader: The network socket to read (receive) the message from.
+    :return: The encoded message without the length prefix.
+    :rtype: bytes
+    """
+
+    header = await reader.readexactly(FRAME_HEADER_SIZE)
+    size = int.from_bytes(header, "big")
+
+    if size > MAX_MSG_BYTES:
+        raise ValueError(f"Message too big: {size} bytes, limit: {MAX_MSG_BYTES} bytes")
+
+    return await reader.readexactly(size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _serialize_node_message(msg_type: PSMessageType, node_id: PSNodeId) -> bytes:
+    """
+    Messages without payload from the node only depend on the message type and
+    the node id, so serialize them only once. They still have to be encrypted each time.
+    """
+
+    return serialize_message((msg_type, node_id))
+
+
 def ps_gen_heartbeat_message(node_id: PSNodeId, secret_key: bytes) -> bytes:
     """
     Generate a heartbeat message to be sent from the node to the server.
@@ -104,8 +285,7 @@ def ps_gen_heartbeat_message(node_id: PSNodeId, secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = (PSMessageType.Heartbeat, node_id)
-    return encode_message(msg, secret_key)
+    return encrypt_message(_serialize_node_message(PSMessageType.Heartbeat, node_id), secret_key)
 
 
 def ps_gen_heartbeat_message_ok(secret_key: bytes) -> bytes:
@@ -120,8 +300,7 @@ def ps_gen_heartbeat_message_ok(secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = PSMessageType.HeartbeatOK
-    return encode_message(msg, secret_key)
+    return encode_static_message(PSMessageType.HeartbeatOK, secret_key)
 
 
 def ps_gen_heartbeat_message_error(secret_key: bytes) -> bytes:
@@ -136,8 +315,7 @@ def ps_gen_heartbeat_message_error(secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = PSMessageType.HeartbeatError
-    return encode_message(msg, secret_key)
+    return encode_static_message(PSMessageType.HeartbeatError, secret_key)
 
 
 def ps_gen_init_message(node_id: PSNodeId, secret_key: bytes) -> bytes:
@@ -153,8 +331,7 @@ def ps_gen_init_message(node_id: PSNodeId, secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = (PSMessageType.Init, node_id)
-    return encode_message(msg, secret_key)
+    return encrypt_message(_serialize_node_message(PSMessageType.Init, node_id), secret_key)
 
 
 def ps_gen_init_message_ok(init_data: Any, secret_key: bytes) -> bytes:
@@ -185,8 +362,7 @@ def ps_gen_init_message_error(secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = PSMessageType.InitError
-    return encode_message(msg, secret_key)
+    return encode_static_message(PSMessageType.InitError, secret_key)
 
 
 def ps_gen_result_message(node_id: PSNodeId, secret_key: bytes, new_data: Any) -> bytes:
@@ -220,8 +396,7 @@ def ps_gen_need_more_data_message(node_id: PSNodeId, secret_key: bytes) -> bytes
     :rtype: bytes
     """
 
-    msg = (PSMessageType.NodeNeedsMoreData, node_id)
-    return encode_message(msg, secret_key)
+    return encrypt_message(_serialize_node_message(PSMessageType.NodeNeedsMoreData, node_id), secret_key)
 
 
 def ps_gen_new_data_message(new_data: Any, secret_key: bytes) -> bytes:
@@ -252,8 +427,7 @@ def ps_gen_result_ok_message(secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = PSMessageType.ResultOK
-    return encode_message(msg, secret_key)
+    return encode_static_message(PSMessageType.ResultOK, secret_key)
 
 
 def ps_gen_quit_message(secret_key: bytes) -> bytes:
@@ -270,7 +444,6 @@ def ps_gen_quit_message(secret_key: bytes) -> bytes:
     :rtype: bytes
     """
 
-    msg = PSMessageType.Quit
-    return encode_message(msg, secret_key)
+    return encode_static_message(PSMessageType.Quit, secret_key)
 
 
@@ -9,24 +9,58 @@ This module defines the node class that does the computation (number crunching).
 
 # Python std modules:
 import asyncio
-from typing import Any
+import socket
+import time
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Optional
 import logging
 
 # Local modules:
 from parasnake.ps_config import PSConfiguration
+from parasnake.ps_eventloop import ps_loop_factory
 from parasnake.ps_nodeid import PSNodeId
 import parasnake.ps_message as psm
 
 logger = logging.getLogger(__name__)
 
+# Time limit in seconds for opening the connection to the server.
+CONNECT_TIMEOUT: float = 10.0
+
+# How often the node tries to reconnect after the connection to the server was lost.
+RECONNECT_ATTEMPTS: int = 3
+
+# Delay before the first reconnect attempt in seconds, doubled for each further attempt.
+RECONNECT_DELAY: float = 0.5
+
+
+class PSNodeMode(IntEnum):
+    """
+    This enum class defines the states of the node's main loop:
+        - Init: This is the first state and the node has to register itself to the server.
+        - NeedData: The node is in this state when it needs data from the server.
+        - HasData: After processing all the data, the node has to send the result back to
+          the server.
+    """
+
+    Init = 0
+    NeedData = 1
+    HasData = 2
+
 
 class PSNode:
     """
     This is the main class that does all coomputation and communication to the server.
     The user of this library has to derive from this class in order to add new custom
     code.
+    The attributes of the base class are fixed (__slots__), a derived class without its own
+    __slots__ gets a normal instance dict for its attributes.
     """
 
+    __slots__ = ("server_address", "server_port", "secret_key", "heartbeat_timeout", "socket_buffer_size", "node_id",
+                 "init_message", "need_more_data_message", "heartbeat_message",
+                 "reader", "writer", "connection_lock", "last_msg_time", "new_result",
+                 "send_handlers", "message_handlers")
+
     def __init__(self, configuration: PSConfiguration):
         """
         Initializes the node using the given configuration.
@@ -38,63 +72,214 @@ class PSNode:
         self.server_port: int = configuration.server_port
         self.secret_key: bytes = configuration.secret_key
         self.heartbeat_timeout: int = configuration.heartbeat_timeout
+        self.socket_buffer_size: int = configuration.socket_buffer_size
         self.node_id: PSNodeId = PSNodeId()
 
+        # These messages only depend on the node id and the key, so encode them only once:
+        self.init_message: bytes = psm.ps_gen_init_message(self.node_id, self.secret_key)
+        self.need_more_data_message: bytes = psm.ps_gen_need_more_data_message(self.node_id, self.secret_key)
+        self.heartbeat_message: bytes = psm.ps_gen_heartbeat_message(self.node_id, self.secret_key)
+
+        # One connection to the server, shared by the main loop and the heartbeat task.
+        # The lock makes sure that only one of them talks to the server at a time:
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connection_lock: asyncio.Lock = asyncio.Lock()
+
+        # When the last message has been sent to the server (time.monotonic()):
+        self.last_msg_time: float = 0.0
+
+        # The result of the last processed data, will be sent to the server:
+        self.new_result: Any = None
+
+        # Maps each mode of the main loop to the method that sends the corresponding messages:
+        self.send_handlers: dict[PSNodeMode, Callable[[], Awaitable[list[Any]]]] = {
+            PSNodeMode.Init: self.ps_send_init,
+            PSNodeMode.NeedData: self.ps_send_need_data,
+            PSNodeMode.HasData: self.ps_send_result,
+        }
+
+        # Maps each message type from the server to the method that handles it in ps_main_loop():
+        self.message_handlers: dict[psm.PSMessageType, Callable[[PSNodeMode, Any], Awaitable[Optional[PSNodeMode]]]] = {
+            psm.PSMessageType.InitOK: self.ps_handle_init_ok,
+            psm.PSMessageType.InitError: self.ps_handle_init_error,
+            psm.PSMessageType.NewDataFromServer: self.ps_handle_new_data,
+            psm.PSMessageType.ResultOK: self.ps_handle_result_ok,
+            psm.PSMessageType.Quit: self.ps_handle_quit,
+            psm.PSMessageType.ConnectionError: self.ps_handle_connection_error,
+        }
+
     def ps_run(self) -> None:
         """
         This method starts an async task to run the node code.
         It is the main entry point that the user has to call.
         """
 
-        logger.info("Starting node with node id: {self.node_id}.")
-        logger.debug(f"Server address: {self.server_address}, port: {self.server_port}.")
-        logger.debug(f"Heartbeat timeout: {self.heartbeat_timeout}")
+        logger.info("Starting node with node id: %s.", self.node_id)
+        logger.debug("Server address: %s, port: %d.", self.server_address, self.server_port)
+        logger.debug("Heartbeat timeout: %s", self.heartbeat_timeout)
 
-        asyncio.run(self.ps_start_tasks())
+        asyncio.run(self.ps_start_tasks(), loop_factory=ps_loop_factory())
 
         logger.info("Will exit node now.")
 
     async def ps_start_tasks(self) -> None:
         """
         This async methods start the main loop and the heartbeat task.
+        When the main loop is done, the heartbeat task is stopped and the connection
+        to the server is closed.
         It is called by the ps_run() method.
         """
 
-        async with asyncio.TaskGroup() as tg:
-            main_task = tg.create_task(self.ps_main_loop())
-            main_task.set_name("MainTask")
-            heartbeat_task = tg.create_task(self.ps_send_heartbeat())
-            heartbeat_task.set_name("HeartbeatTask")
+        main_task = asyncio.create_task(self.ps_main_loop(), name="MainTask")
+        heartbeat_task = asyncio.create_task(self.ps_send_heartbeat(), name="HeartbeatTask")
+
+        try:
+            await main_task
+        finally:
+            # The heartbeat is not needed anymore when the main loop is done,
+            # no need to wait for its next round:
+            heartbeat_task.cancel()
+            results = await asyncio.gather(heartbeat_task, return_exceptions=True)
+
+            if not isinstance(results[0], (asyncio.CancelledError, type(None))):
+                logger.error("Heartbeat task failed: %s", results[0])
+
+            await self.ps_close_connection()
+
+    async def ps_open_connection(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """
+        This async method opens the connection to the server.
+        It gives up after CONNECT_TIMEOUT seconds and enables TCP keepalive, so that
+        a dead server is noticed even while the node is busy processing data.
+        If socket_buffer_size is set in the configuration, the send and receive buffers get that size.
+        (asyncio already disables Nagle's algorithm for TCP connections.)
+        It is called by ps_send_msgs_return_answers() when there is no connection yet.
+
+        :return: The reader and writer of the new connection.
+        :rtype: tuple[asyncio.StreamReader, asyncio.StreamWriter]
+        """
+
+        logger.debug("Connect to server.")
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server_address, self.server_port), CONNECT_TIMEOUT)
+        self.reader, self.writer = reader, writer
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+            if self.socket_buffer_size > 0:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer_size)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+
+        return reader, writer
+
+    async def ps_close_connection(self) -> None:
+        """
+        This async method closes the connection to the server, if there is one.
+        It is called by ps_start_tasks() when the node is done and after a connection error.
+        """
+
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+
+        if writer is not None:
+            logger.debug("Close connection to server.")
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
     async def ps_send_msg_return_answer(self, msg: bytes) -> Any:
         """
         This async method send an encoded message to the server and awaits for
         the server to respond. The message from the server is decoded and returned.
-        This async method is called from ps_main_loop().
+        This async method is called from ps_send_heartbeat().
 
         :param msg: The already encoded message that is send to the server.
         :return: The decoded message from the server.
         :rtype: Any
         """
 
-        try:
-            logger.debug("Send message to server.")
-            reader, writer = await asyncio.open_connection(self.server_address, self.server_port)
-
-            writer.write(msg)
-            writer.write_eof()
-            await writer.drain()
-
-            data = await reader.read()
-            msg = psm.decode_message(data, self.secret_key)
+        answers = await self.ps_send_msgs_return_answers([msg])
+        return answers[0]
 
-            writer.close()
-            await writer.wait_closed()
+    async def ps_send_msgs_return_answers(self, msgs: list[bytes]) -> list[Any]:
+        """
+        This async method sends several encoded messages to the server in one go and
+        awaits for the server to respond to each of them, in the same order.
+        The connection to the server is opened on first use and then kept open.
+        If the connection is lost, the node reconnects and sends the messages that have not
+        been answered yet again, waiting a bit longer before each new attempt.
+        A message whose answer got lost may still reach the server twice.
+        The messages from the server are decoded and returned.
+        If there is a connection error or a message is bigger than ps_message.MAX_MSG_BYTES
+        only the ConnectionError message is returned.
+        This async method is called from ps_main_loop() and ps_send_msg_return_answer().
+
+        :param msgs: The already encoded messages that are send to the server.
+        :return: The decoded messages from the server.
+        :rtype: list[Any]
+        """
 
-            return msg
-        except ConnectionRefusedError:
-            logger.error("Could not connect to server. Will exit now.")
-            return psm.PSMessageType.ConnectionError
+        try:
+            headers = [psm.frame_header(msg) for msg in msgs]
+        except ValueError as e:
+            # Sending it would only make the server drop the connection, again and again:
+            logger.error("Can't send message to server: %s", e)
+            return [psm.PSMessageType.ConnectionError]
+
+        # Answers that have already been received, kept across reconnects:
+        answers: list[Any] = []
+
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            async with self.connection_lock:
+                try:
+                    reader, writer = self.reader, self.writer
+                    if reader is None or writer is None:
+                        reader, writer = await self.ps_open_connection()
+
+                    # The server has already handled the messages that were answered,
+                    # only send the remaining ones (again):
+                    pending = len(answers)
+
+                    logger.debug("Send message to server.")
+                    send_time = time.monotonic()
+                    for header, msg in zip(headers[pending:], msgs[pending:]):
+                        writer.writelines((header, msg))
+                    await writer.drain()
+
+                    while len(answers) < len(msgs):
+                        answers.append(psm.decode_message(await psm.read_frame(reader), self.secret_key))
+                    self.last_msg_time = send_time
+
+                    return answers
+                except (OSError, asyncio.IncompleteReadError, TimeoutError) as e:
+                    # OSError includes ConnectionError and also covers an unreachable host
+                    # or a failed name lookup while the server is down:
+                    if isinstance(e, ConnectionRefusedError) and attempt == 0:
+                        # There was no connection to lose, the server isn't running:
+                        logger.error("Could not connect to server. Will exit now.")
+                        return [psm.PSMessageType.ConnectionError]
+
+                    # The server may just be restarting, so try again:
+                    logger.error("Connection to server lost: %s", e)
+                    await self.ps_close_connection()
+                except ValueError as e:
+                    logger.error("Invalid message from server: %s", e)
+                    await self.ps_close_connection()
+                    return [psm.PSMessageType.ConnectionError]
+
+            if attempt < RECONNECT_ATTEMPTS:
+                delay = RECONNECT_DELAY * (2 ** attempt)
+                logger.debug("Reconnect to server in %s seconds.", delay)
+                await asyncio.sleep(delay)
+
+        logger.error("Could not reconnect to server. Will exit now.")
+        return [psm.PSMessageType.ConnectionError]
 
     async def ps_main_loop(self) -> None:
         """
@@ -102,104 +287,237 @@ class PSNode:
         It manages all the communication between the node and the server.
         It is called from ps_start_tasks().
 
-        The main loop is driven by the mode state:
-            - init: This is the first state and the node has to register itself to the server.
-            - need_data: The node is in this state when it needs data from the server.
-            - has_data: After processing all the data, the node has to send the result back to
-              the server.
+        The main loop is driven by the mode state, see PSNodeMode.
+        For each mode the messages are sent via send_handlers by the corresponding
+        ps_send_* method. The answer from the server is dispatched via message_handlers
+        to the corresponding ps_handle_* method, which returns the next mode.
         """
 
         logger.debug("Start main task.")
-        need_more_data_message = psm.ps_gen_need_more_data_message(self.node_id, self.secret_key)
-        init_message = psm.ps_gen_init_message(self.node_id, self.secret_key)
 
-        msg = None
-        new_result = None
-        mode: str = "init"
+        mode: Optional[PSNodeMode] = PSNodeMode.Init
 
-        while True:
-            match mode:
-                case "init":
-                    msg = await self.ps_send_msg_return_answer(init_message)
-                case "need_data":
-                    msg = await self.ps_send_msg_return_answer(need_more_data_message)
-                case "has_data":
-                    result_msg = psm.ps_gen_result_message(self.node_id, self.secret_key, new_result)
-                    msg = await self.ps_send_msg_return_answer(result_msg)
+        while mode is not None:
+            answers = await self.send_handlers[mode]()
 
-            match msg:
-                case (psm.PSMessageType.InitOK, data):
-                    if mode == "init":
-                        logger.debug("Init node OK.")
-                        self.ps_init(data)
-                        mode = "need_data"
-                    else:
-                        logger.error("Mode should be init: {mode}.")
-                        break
-                case psm.PSMessageType.InitError:
-                    logger.error("Init node failed!")
-                    break
-                case (psm.PSMessageType.NewDataFromServer, new_data):
-                    if mode == "need_data":
-                        logger.debug("Received new data from server.")
-                        match new_data:
-                            case None:
-                                logger.debug("No more data to process! Waiting for other nodes to finish the job.")
-                                await asyncio.sleep(10.0)
-                                mode = "need_data"
-                            case _:
-                                new_result = await self.ps_process_data_thread(new_data)
-                                logger.debug("New data has been processed.")
-                                mode = "has_data"
-                    else:
-                        logger.error("Mode should be need_data: {mode}.")
-                        break
-                case psm.PSMessageType.ResultOK:
-                    if mode == "has_data":
-                        logger.debug("New processed data has been sent to server.")
-                        mode = "need_data"
-                    else:
-                        logger.error("Mode should be has_data: {mode}")
-                        break
-                case psm.PSMessageType.Quit:
-                    logger.debug("Job finished.")
-                    break
-                case psm.PSMessageType.ConnectionError:
-                    logger.error("Connection error, will exit now.")
-                    break
-                case _:
+            for msg in answers:
+                # Messages from the server are either just the message type or a tuple
+                # of message type and data.
+                if isinstance(msg, tuple) and len(msg) == 2:
+                    msg_type, data = msg
+                else:
+                    msg_type, data = msg, None
+
+                handler = self.message_handlers.get(msg_type)
+
+                if handler is None:
                     logger.error("Received unknown message from server!")
+                    mode = None
+                else:
+                    mode = await handler(mode, data)
+
+                # After an InitError the node registers again, the remaining answers are
+                # just errors as well:
+                if mode is None or mode == PSNodeMode.Init:
                     break
 
+    async def ps_send_init(self) -> list[Any]:
+        """
+        Registers the node to the server (PSNodeMode.Init).
+        This and the following ps_send_* methods are called from ps_main_loop().
+
+        :return: The answers from the server.
+        :rtype: list[Any]
+        """
+
+        return await self.ps_send_msgs_return_answers([self.init_message])
+
+    async def ps_send_need_data(self) -> list[Any]:
+        """
+        Asks the server for new data (PSNodeMode.NeedData).
+
+        :return: The answers from the server.
+        :rtype: list[Any]
+        """
+
+        return await self.ps_send_msgs_return_answers([self.need_more_data_message])
+
+    async def ps_send_result(self) -> list[Any]:
+        """
+        Sends the result back to the server (PSNodeMode.HasData) and asks for new data
+        in one go, the answers are handled one after the other.
+        The result is kept until the server has confirmed it (see ps_handle_result_ok()).
+
+        :return: The answers from the server.
+        :rtype: list[Any]
+        """
+
+        result_msg = psm.ps_gen_result_message(self.node_id, self.secret_key, self.new_result)
+
+        return await self.ps_send_msgs_return_answers([result_msg, self.need_more_data_message])
+
+    async def ps_handle_init_ok(self, mode: PSNodeMode, data: Any) -> Optional[PSNodeMode]:
+        """
+        Handles the InitOK message from the server, the data is passed to ps_init().
+        If the node registers again with a result that hasn't been sent yet, it sends
+        that result next.
+        This and the following ps_handle_* methods are called from ps_main_loop().
+        Each one gets the current mode and the data of the message and returns the
+        next mode, or None if the main loop should stop.
+
+        :param mode: The current mode of the main loop.
+        :param data: The init data from the server.
+        :return: The next mode or None.
+        :rtype: Optional[PSNodeMode]
+        """
+
+        if mode == PSNodeMode.Init:
+            logger.debug("Init node OK.")
+            self.ps_init(data)
+
+            if self.new_result is not None:
+                return PSNodeMode.HasData
+
+            return PSNodeMode.NeedData
+        else:
+            logger.error("Mode should be Init: %s.", mode.name)
+            return None
+
+    async def ps_handle_init_error(self, mode: PSNodeMode, data: Any) -> Optional[PSNodeMode]:
+        """
+        Handles the InitError message from the server.
+        If the node was registered before, the server has timed it out (see PSServer.ps_check_heartbeat())
+        and the node registers again. Otherwise the node stops.
+
+        :param mode: The current mode of the main loop.
+        :param data: Not used.
+        :return: PSNodeMode.Init or None.
+        :rtype: Optional[PSNodeMode]
+        """
+
+        if mode == PSNodeMode.Init:
+            logger.error("Init node failed!")
+            return None
+
+        logger.warning("Node has been timed out by the server, register again.")
+        return PSNodeMode.Init
+
+    async def ps_handle_new_data(self, mode: PSNodeMode, data: Any) -> Optional[PSNodeMode]:
+        """
+        Handles the NewDataFromServer message, the data is processed in a separate thread.
+        If the server has no more data (None) the node waits a bit and asks again.
+
+        :param mode: The current mode of the main loop.
+        :param data: The new data from the server.
+        :return: The next mode or None.
+        :rtype: Optional[PSNodeMode]
+        """
+
+        if mode == PSNodeMode.NeedData:
+            logger.debug("Received new data from server.")
+            if data is None:
+                logger.debug("No more data to process! Waiting for other nodes to finish the job.")
+                await asyncio.sleep(10.0)
+                return PSNodeMode.NeedData
+            else:
+                self.new_result = await self.ps_process_data_thread(data)
+                logger.debug("New data has been processed.")
+                return PSNodeMode.HasData
+        else:
+            logger.error("Mode should be NeedData: %s.", mode.name)
+            return None
+
+    async def ps_handle_result_ok(self, mode: PSNodeMode, data: Any) -> Optional[PSNodeMode]:
+        """
+        Handles the ResultOK message from the server, the result is not needed anymore
+        and the node asks for new data.
+
+        :param mode: The current mode of the main loop.
+        :param data: Not used.
+        :return: The next mode or None.
+        :rtype: Optional[PSNodeMode]
+        """
+
+        if mode == PSNodeMode.HasData:
+            logger.debug("New processed data has been sent to server.")
+            self.new_result = None
+            return PSNodeMode.NeedData
+        else:
+            logger.error("Mode should be HasData: %s.", mode.name)
+            return None
+
+    async def ps_handle_quit(self, mode: PSNodeMode, data: Any) -> Optional[PSNodeMode]:
+        """
+        Handles the Quit message from the server, the job is done and the node stops.
+
+        :param mode: The current mode of the main loop.
+        :param data: Not used.
+        :return: Always None.
+        :rtype: Optional[PSNodeMode]
+        """
+
+        logger.debug("Job finished.")
+        return None
+
+    async def ps_handle_connection_error(self, mode: PSNodeMode, data: Any) -> Optional[PSNodeMode]:
+        """
+        Handles a connection error to the server, the node stops.
+
+        :param mode: The current mode of the main loop.
+        :param data: Not used.
+        :return: Always None.
+        :rtype: Optional[PSNodeMode]
+        """
+
+        logger.error("Connection error, will exit now.")
+        return None
+
     async def ps_send_heartbeat(self) -> None:
         """
         This async method sends the heartbeat message to the server.
         The rate can be configured in the configuration file:
-        heartbeat_timeout. The default value is 5 minutes.
-        If the node misses a heartbeat the server knows that ther is sth. wrong.
+        heartbeat_timeout (T). The default value is 5 minutes.
+        Since every other message to the server counts as well, the heartbeat is only
+        sent when the node hasn't sent anything else for T / 2.
+        If the server hasn't heard anything from the node for 2 * T, it closes the node's
+        connection and times the node out (see PSServer.ps_check_heartbeat()).
+        If the server has timed out the node anyway (HeartbeatError), the main loop registers
+        the node again with its next message, so the heartbeat task just keeps going.
+        The same is true if the connection to the server is lost (ConnectionError).
         The data is marked as dirty and will be sent to another node to be processed.
         The heartbeat task is run asynchronouesly in the background and is called
         by ps_start_tasks().
         """
 
         logger.debug("Start heartbeat task.")
-        heartbeat_message = psm.ps_gen_heartbeat_message(self.node_id, self.secret_key)
+        self.last_msg_time = time.monotonic()
 
         while True:
-            await asyncio.sleep(self.heartbeat_timeout)
+            # The server takes every message from the node as a sign of life,
+            # so only send a heartbeat if the node has been quiet for too long:
+            # Half the timeout leaves enough room for a slow network:
+            remaining = self.last_msg_time + (self.heartbeat_timeout / 2) - time.monotonic()
+
+            if remaining > 0.0:
+                await asyncio.sleep(remaining)
+                continue
 
             logger.debug("Send heartbeat message to server.")
-            msg = await self.ps_send_msg_return_answer(heartbeat_message)
+            msg = await self.ps_send_msg_return_answer(self.heartbeat_message)
 
             match msg:
                 case psm.PSMessageType.HeartbeatOK:
                     logger.debug("Heartbeat OK.")
                 case psm.PSMessageType.HeartbeatError:
-                    logger.debug("Heartbeat Error!")
-                    break
+                    logger.warning("Heartbeat Error, node has been timed out by the server!")
                 case psm.PSMessageType.Quit:
                     logger.debug("Job finished, quit.")
                     break
+                case psm.PSMessageType.ConnectionError:
+                    # The main loop reconnects with its next message, the heartbeat is still
+                    # needed after that. It is cancelled by ps_start_tasks() when the node is done:
+                    logger.warning("Heartbeat: connection to server lost, will try again.")
+                    await asyncio.sleep(self.heartbeat_timeout / 2)
                 case _:
                     logger.error("Received unknown message from server!")
                     break
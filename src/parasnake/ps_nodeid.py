@@ -13,19 +13,56 @@ it sends an error to the node.
 
 
 import uuid
+from typing import Callable
 
 
 class PSNodeId:
+    # The id is kept as 16 raw bytes together with their hash, since node ids are
+    # compared and used as dict keys by the server for every message:
+    __slots__ = ("_id_bytes", "_hash")
+
     def __init__(self):
-        self.id = uuid.uuid4()
+        self._set_bytes(uuid.uuid4().bytes)
+
+    def _set_bytes(self, id_bytes: bytes) -> None:
+        self._id_bytes: bytes = id_bytes
+        self._hash: int = hash(id_bytes)
+
+    @property
+    def id(self) -> uuid.UUID:
+        return uuid.UUID(bytes=self._id_bytes)
+
+    @id.setter
+    def id(self, value: uuid.UUID) -> None:
+        self._set_bytes(value.bytes)
 
     def __eq__(self, other) -> bool:
-        return self.id == other.id
+        if not isinstance(other, PSNodeId):
+            return NotImplemented
+
+        return self._id_bytes == other._id_bytes
 
     def __hash__(self):
-        return hash(self.id)
+        return self._hash
 
     def __repr__(self) -> str:
         return f"PSNodeId({self.id})"
 
+    def __reduce__(self) -> tuple[Callable[[bytes], "PSNodeId"], tuple[bytes]]:
+        # Pickle only the 16 raw bytes of the id:
+        return (_node_id_from_bytes, (self._id_bytes,))
+
+
+def _node_id_from_bytes(id_bytes: bytes) -> PSNodeId:
+    """
+    Recreates a node id from its raw bytes, used when unpickling a PSNodeId.
+
+    :param id_bytes: The 16 raw bytes of the id.
+    :return: The node id.
+    :rtype: PSNodeId
+    """
+
+    node_id = PSNodeId.__new__(PSNodeId)
+    node_id._set_bytes(id_bytes)
 
+    return node_id
@@ -12,38 +12,75 @@ TODO: Describe the caller and callee.
 import time
 import datetime
 import asyncio
-from typing import Any, Optional
+import concurrent.futures
+from typing import Any, Awaitable, Callable, Optional
 import logging
+import socket
 import threading
 
 # Local modules:
 from parasnake.ps_config import PSConfiguration
+from parasnake.ps_eventloop import ps_loop_factory
 from parasnake.ps_nodeid import PSNodeId
 import parasnake.ps_message as psm
 
 logger = logging.getLogger(__name__)
 
+# Messages bigger than this (in bytes) are decoded in a separate thread,
+# so that they don't block the other nodes. Smaller ones are faster to decode directly:
+DECODE_THREAD_SIZE: int = 64 * 1024
+
 
 class PSServer:
     def __init__(self, configuration: PSConfiguration):
         self.server_port: int = configuration.server_port
         self.secret_key: bytes = configuration.secret_key
         self.heartbeat_timeout: int = configuration.heartbeat_timeout
-        self.all_nodes: dict[PSNodeId, float] = {}
-        self.quit: bool = False
+        # Time of the last message from each node, in nanoseconds (time.monotonic_ns()).
+        # Updated nodes are moved to the end, so the dict is sorted by time (oldest first):
+        self.all_nodes: dict[PSNodeId, int] = {}
+        # Set when the job is done, all nodes get the Quit message from then on:
+        self.quit_event: asyncio.Event = asyncio.Event()
         self.quit_counter: int = configuration.quit_counter
+        self.use_threads: bool = configuration.use_threads
+        self.socket_buffer_size: int = configuration.socket_buffer_size
+        # Long lived threads for the user callbacks, instead of asyncio's default executor:
+        self.executor: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=configuration.worker_threads, thread_name_prefix="ps_worker")
         self.lock: threading.Lock = threading.Lock()
+        # The connections of the currently connected nodes (see ps_handle_node()):
+        self.node_writers: set[asyncio.StreamWriter] = set()
+        # Limits the number of messages that are handled at the same time:
+        self.semaphore: asyncio.Semaphore = asyncio.Semaphore(configuration.max_concurrent)
+        # These answers never change, so encode them only once:
+        self.quit_message: bytes = psm.ps_gen_quit_message(self.secret_key)
+        self.init_error_message: bytes = psm.ps_gen_init_message_error(self.secret_key)
+        self.heartbeat_ok_message: bytes = psm.ps_gen_heartbeat_message_ok(self.secret_key)
+        self.heartbeat_error_message: bytes = psm.ps_gen_heartbeat_message_error(self.secret_key)
+        self.result_ok_message: bytes = psm.ps_gen_result_ok_message(self.secret_key)
+
+        # Maps the message type from the node to the method that handles it:
+        self.message_handlers: dict[psm.PSMessageType, Callable[..., Awaitable[None]]] = {
+            psm.PSMessageType.Init: self.ps_handle_init,
+            psm.PSMessageType.Heartbeat: self.ps_handle_heartbeat,
+            psm.PSMessageType.NodeNeedsMoreData: self.ps_handle_need_data,
+            psm.PSMessageType.NewResultFromNode: self.ps_handle_result,
+        }
 
     def ps_run(self) -> None:
         """
         This methods uses asyncio.run to call the main loop (ps_main_loop).
+        If uvloop is installed it is used as the event loop, see ps_eventloop.
         It is the main entry point for the user code.
         """
 
-        logger.info(f"Starting server with port: {self.server_port}.")
-        logger.debug(f"Heartbeat timeout: {self.heartbeat_timeout}.")
+        logger.info("Starting server with port: %s.", self.server_port)
+        logger.debug("Heartbeat timeout: %s.", self.heartbeat_timeout)
 
-        asyncio.run(self.ps_main_loop())
+        try:
+            asyncio.run(self.ps_main_loop(), loop_factory=ps_loop_factory())
+        finally:
+            self.executor.shutdown()
 
         logger.info("Saving data...")
         self.ps_save_data()
@@ -53,44 +90,92 @@ class PSServer:
         """
         This method registers a new node with the given node id.
         It also sets the heartbeat time to the current time.
-        It's called from the ps_handle_node() method.
+        It's called from the ps_handle_init() method.
 
         :param node_id: The node id of the new node.
         """
 
         logger.debug("Register new node.")
-        now: float = time.time()
+        now: int = time.monotonic_ns()
         self.all_nodes[node_id] = now
 
     def ps_update_node_time(self, node_id: PSNodeId) -> None:
         """
         This methods updates the heartbeat time for the given node.
-        It's called from the ps_handle_node() method.
+        The node is moved to the end of all_nodes, to keep it sorted by time.
+        Like before, a node that is not registered yet is simply added.
+        ps_handle_message() does the same inline for every message of a registered node.
 
         :param node_id: The node id of the node whose heartbeat time should be updated.
         """
 
         logger.debug("Update node time.")
-        now: float = time.time()
+        self.all_nodes.pop(node_id, None)
+        now: int = time.monotonic_ns()
         self.all_nodes[node_id] = now
 
-    async def ps_write_msg(self, writer, msg) -> None:
+    def ps_set_socket_options(self, writer) -> None:
         """
-        This is a helper method to send a message over the network and await for it to finish.
+        This method enables TCP keepalive on the connection of a node, so that the kernel
+        notices dead nodes that still hold a connection open. On Linux the keepalive probes
+        start after heartbeat_timeout seconds.
+        If socket_buffer_size is set in the configuration, the send and receive buffers get that size.
+        (asyncio already disables Nagle's algorithm for TCP connections.)
         It's called from the ps_handle_node() method.
 
+        :param writer: The network socket of the node connection.
+        """
+
+        sock = writer.get_extra_info("socket")
+        if sock is None:
+            return
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        if self.socket_buffer_size > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            idle = max(1, int(self.heartbeat_timeout))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, idle // 3))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+    def ps_write_msg(self, writer, msg) -> None:
+        """
+        This is a helper method to send a message over the network.
+        The message is prefixed with its length, see ps_message.frame_message().
+        It only puts the message into the transport buffer and doesn't wait, ps_handle_node()
+        drains the buffer when it gets too full, i.e. the node doesn't read fast enough.
+        If the message is bigger than ps_message.MAX_MSG_BYTES an error is logged and the
+        connection is closed.
+        It's called from the ps_handle_* methods.
+
         :param writer: The network socket to write (send) the message to.
         :param msg: The message to write (send).
         """
 
-        writer.write(msg)
-        writer.write_eof()
-        await writer.drain()
+        try:
+            header = psm.frame_header(msg)
+        except ValueError as e:
+            # The node would reject it, closing the connection ends ps_handle_node():
+            logger.error("Can't send answer to node: %s", e)
+            writer.close()
+            return
+
+        writer.writelines((header, msg))
 
     async def ps_handle_node(self, reader, writer) -> None:
         """
         This method handles all the node communication.
         It's called from ps_main_loop() when a node connects to the server.
+        The node can send several length prefixed messages over the same connection,
+        each one is handled by ps_handle_message() until the node closes the connection.
+        If the node is silent (or doesn't read its answers) for twice the heartbeat timeout,
+        the connection is closed.
+        Big messages (usually results) are decoded in a separate thread, see DECODE_THREAD_SIZE.
+        At most max_concurrent messages (see configuration) are handled at the same time.
         TODO: Describe the message types.
 
         The nodes can send the following messages:
@@ -124,53 +209,147 @@ class PSServer:
         """
 
         logger.debug("Connection from node.")
+        self.ps_set_socket_options(writer)
+
+        # A working node sends at least one message per heartbeat_timeout:
+        read_timeout: float = 2.0 * self.heartbeat_timeout
+
+        # Remember this connection, so that it can be closed when the server shuts down:
+        self.node_writers.add(writer)
+
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(psm.read_frame(reader), read_timeout)
+                except asyncio.IncompleteReadError:
+                    # The node has closed the connection.
+                    break
+                except TimeoutError:
+                    logger.info("Node connection idle for too long, closing it.")
+                    break
+                except ValueError as e:
+                    logger.error("Invalid message from node: %s", e)
+                    break
 
-        data = await reader.read()
-        msg = psm.decode_message(data, self.secret_key)
+                if len(data) > DECODE_THREAD_SIZE:
+                    msg = await asyncio.to_thread(psm.decode_message, data, self.secret_key)
+                else:
+                    msg = psm.decode_message(data, self.secret_key)
+
+                try:
+                    async with self.semaphore:
+                        await self.ps_handle_message(writer, msg)
+
+                    # Small answers just stay in the buffer, only wait if it's above its high-water mark:
+                    transport = writer.transport
+                    if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+                        await asyncio.wait_for(writer.drain(), read_timeout)
+                except TimeoutError:
+                    logger.error("Node doesn't read its answers, closing the connection.")
+                    break
+        finally:
+            self.node_writers.discard(writer)
+            writer.close()
+            await writer.wait_closed()
+
+    async def ps_handle_message(self, writer, msg: Any) -> None:
+        """
+        This method handles one decoded message from a node and sends the answer back.
+        The message is passed on to the handler for its type, see message_handlers.
+        It's called from ps_handle_node() for every message the node sends over the connection.
 
-        if self.quit:
+        :param writer: The network socket to write (send) the answer to.
+        :param msg: The decoded message from the node.
+        """
+
+        if self.quit_event.is_set():
             logger.debug("Send quit message, job is done.")
-            await self.ps_write_msg(writer, psm.ps_gen_quit_message(self.secret_key))
+            self.ps_write_msg(writer, self.quit_message)
+            return
+
+        msg_type = msg[0]
+        node_id = msg[1]
+        handler = self.message_handlers.get(msg_type)
+
+        if handler is None:
+            logger.error("Unknown message from node: %s", msg_type)
+            return
+
+        if msg_type != psm.PSMessageType.Init:
+            # All other messages need a registered node and count as a sign of life.
+            # Pop and insert moves the node to the end of all_nodes (see ps_update_node_time()):
+            all_nodes = self.all_nodes
+            if all_nodes.pop(node_id, None) is None:
+                logger.error("Node id not registered yet: %s", node_id)
+                if msg_type == psm.PSMessageType.Heartbeat:
+                    self.ps_write_msg(writer, self.heartbeat_error_message)
+                else:
+                    self.ps_write_msg(writer, self.init_error_message)
+                return
+            all_nodes[node_id] = time.monotonic_ns()
+
+        await handler(writer, *msg[1:])
+
+    async def ps_handle_init(self, writer, node_id: PSNodeId) -> None:
+        """
+        Handles the Init message from the node.
+        This and the following ps_handle_* methods are called from ps_handle_message(),
+        they get the network socket to write the answer to and the rest of the message.
+        For all messages except Init ps_handle_message() has already checked that the node
+        is registered and has updated its time.
+
+        :param writer: The network socket to write (send) the answer to.
+        :param node_id: The id of the node.
+        """
+
+        logger.debug("Init message.")
+        if node_id in self.all_nodes:
+            logger.error("Node id already registered: %s", node_id)
+            self.ps_write_msg(writer, self.init_error_message)
         else:
-            match msg:
-                case (psm.PSMessageType.Init, node_id):
-                    logger.debug("Init message.")
-                    if node_id in self.all_nodes:
-                        logger.error("Node id already registered: {node_id}")
-                        await self.ps_write_msg(writer, psm.ps_gen_init_message_error(self.secret_key))
-                    else:
-                        self.ps_register_new_node(node_id)
-                        init_data = await self.ps_get_init_data_thread(node_id)
-                        await self.ps_write_msg(writer, psm.ps_gen_init_message_ok(init_data, self.secret_key))
-                case (psm.PSMessageType.Heartbeat, node_id):
-                    logger.debug("Heartbeat message.")
-                    if node_id in self.all_nodes:
-                        self.ps_update_node_time(node_id)
-                        await self.ps_write_msg(writer, psm.ps_gen_heartbeat_message_ok(self.secret_key))
-                    else:
-                        logger.error("Node id not registered yet: {node_id}")
-                        await self.ps_write_msg(writer, psm.ps_gen_heartbeat_message_error(self.secret_key))
-                case (psm.PSMessageType.NodeNeedsMoreData, node_id):
-                    logger.debug("Node needs more data.")
-                    if node_id in self.all_nodes:
-                        self.ps_update_node_time(node_id)
-                        new_data = await self.ps_get_new_data_thread(node_id)
-                        await self.ps_write_msg(writer, psm.ps_gen_new_data_message(new_data, self.secret_key))
-                    else:
-                        logger.error("Node id not registered yet: {node_id}")
-                        await self.ps_write_msg(writer, psm.ps_gen_init_message_error(self.secret_key))
-                case (psm.PSMessageType.NewResultFromNode, node_id, result):
-                    logger.debug("New result from node.")
-                    if node_id in self.all_nodes:
-                        self.ps_update_node_time(node_id)
-                        await self.ps_process_result_thread(node_id, result)
-                        await self.ps_write_msg(writer, psm.ps_gen_result_ok_message(self.secret_key))
-                    else:
-                        logger.error("Node id not registered yet: {node_id}")
-                        await self.ps_write_msg(writer, psm.ps_gen_init_message_error(self.secret_key))
+            self.ps_register_new_node(node_id)
+            init_data = await self.ps_get_init_data_thread(node_id)
+            self.ps_write_msg(writer, psm.ps_gen_init_message_ok(init_data, self.secret_key))
 
-        writer.close()
-        await writer.wait_closed()
+    async def ps_handle_heartbeat(self, writer, node_id: PSNodeId) -> None:
+        """
+        Handles the Heartbeat message from the node.
+
+        :param writer: The network socket to write (send) the answer to.
+        :param node_id: The id of the node.
+        """
+
+        logger.debug("Heartbeat message.")
+        self.ps_write_msg(writer, self.heartbeat_ok_message)
+
+    async def ps_handle_need_data(self, writer, node_id: PSNodeId) -> None:
+        """
+        Handles the NodeNeedsMoreData message from the node.
+
+        :param writer: The network socket to write (send) the answer to.
+        :param node_id: The id of the node.
+        """
+
+        logger.debug("Node needs more data.")
+        new_data = await self.ps_get_new_data_thread(node_id)
+        self.ps_write_msg(writer, psm.ps_gen_new_data_message(new_data, self.secret_key))
+
+    async def ps_handle_result(self, writer, node_id: PSNodeId, result: Any) -> None:
+        """
+        Handles the NewResultFromNode message from the node.
+
+        :param writer: The network socket to write (send) the answer to.
+        :param node_id: The id of the node.
+        :param result: The processed data from the node.
+        """
+
+        logger.debug("New result from node.")
+        job_done = await self.ps_process_result_thread(node_id, result)
+        self.ps_write_msg(writer, self.result_ok_message)
+
+        # The job can only be finished after a new result:
+        if job_done:
+            self.quit_event.set()
 
     async def ps_main_loop(self) -> None:
         """
@@ -181,71 +360,107 @@ class PSServer:
 
         logger.debug("Start main server task.")
         start_time = datetime.datetime.now()
-        logger.info(f"Starting now: {start_time}")
+        logger.info("Starting now: %s", start_time)
 
-        server = await asyncio.start_server(self.ps_handle_node, "0.0.0.0", self.server_port)
+        # Many nodes may connect at once, so allow a longer queue of pending connections:
+        server = await asyncio.start_server(self.ps_handle_node, "0.0.0.0", self.server_port, backlog=1024)
 
         addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
-        logger.debug(f"Serving on {addrs}")
+        logger.debug("Serving on %s", addrs)
 
         while True:
-            await asyncio.sleep(10)
-
-            if self.quit:
-                logger.debug(f"Quit counter: {self.quit_counter}")
+            if self.quit_event.is_set():
+                # Give all nodes the chance to get the Quit message:
+                await asyncio.sleep(10)
+                logger.debug("Quit counter: %s", self.quit_counter)
                 self.quit_counter = self.quit_counter - 1
                 if self.quit_counter == 0:
                     break
             else:
-                if self.ps_is_job_done():
-                    self.quit = True
-                else:
-                    self.ps_check_heartbeat()
+                try:
+                    # Wakes up early if the job is done (see ps_handle_result()):
+                    await asyncio.wait_for(self.quit_event.wait(), 10)
+                except TimeoutError:
+                    # The user callbacks may run in the executor at the same time:
+                    with self.lock:
+                        job_done = self.ps_is_job_done()
+
+                    if job_done:
+                        self.quit_event.set()
+                    else:
+                        self.ps_check_heartbeat()
 
         logger.debug("Closing server connections...")
         server.close()
+
+        # All nodes had the chance to get the Quit message, so the remaining connections are
+        # idle or stuck. Close them instead of waiting for their read timeout, their
+        # ps_handle_node() then ends and wait_closed() returns:
+        for writer in list(self.node_writers):
+            writer.close()
+
         await server.wait_closed()
 
         end_time = datetime.datetime.now()
-        logger.info(f"Finished on: {end_time}")
+        logger.info("Finished on: %s", end_time)
 
         time_taken = end_time - start_time
         in_seconds = time_taken.total_seconds()
         in_minutes = in_seconds / 60.0
         in_hours = in_minutes / 60.0
 
-        logger.info(f"Time taken: in seconds: {in_seconds}")
-        logger.info(f"Time taken: in minutes: {in_minutes}")
-        logger.info(f"Time taken: in hours: {in_hours}")
+        logger.info("Time taken: in seconds: %s", in_seconds)
+        logger.info("Time taken: in minutes: %s", in_minutes)
+        logger.info("Time taken: in hours: %s", in_hours)
 
     def ps_check_heartbeat(self) -> None:
         """
-        This method checks the heartbeat values for all the active nodes.
-        If one node failed to send the heartbeat message, the ps_node_timeout()
-        method is called with the corresponding nodeid.
+        This method checks the heartbeat values of the active nodes, starting with the oldest one.
+        If one node hasn't sent anything for twice the heartbeat_timeout, it is removed from the
+        active nodes and the ps_node_timeout() method is called with the corresponding nodeid.
         This method is called from ps_main_loop().
         """
 
         logger.debug("Check heartbeat of all nodes.")
 
-        now: float = time.time()
+        # The nodes send their heartbeat after half of heartbeat_timeout, so a node is only
+        # timed out after it missed several of them. A busy connection must not evict it:
+        deadline: int = time.monotonic_ns() - 2 * self.heartbeat_timeout * 1_000_000_000
+        stale: list[PSNodeId] = []
 
+        # all_nodes is sorted by time, so stop at the first node that is still alive:
         for k, v in self.all_nodes.items():
-            if int(now - v + 1.0) > self.heartbeat_timeout:
+            if v >= deadline:
+                break
+            stale.append(k)
+
+        if not stale:
+            return
+
+        # ps_node_timeout() changes the same data as the user callbacks in the executor:
+        with self.lock:
+            for k in stale:
+                logger.info("Node timed out: %s", k)
+                del self.all_nodes[k]
                 self.ps_node_timeout(k)
 
     async def ps_get_init_data_thread(self, node_id: PSNodeId) -> Any:
         """
         This method starts a new background thread to retrieve the initial data
-        for the given node. Since this call may block it is run in a separate thread.
-        This method is called from ps_handle_node() (Init message).
+        for the given node. Since this call may block it is run in a separate thread (see executor).
+        If use_threads is switched off in the configuration, it is called directly instead.
+        This method is called from ps_handle_init() (Init message).
 
         :param node_id: The id of the node that receives the initialisation data.
         :return: The init data for the given node.
         :rtype: Any
         """
 
-        return await asyncio.to_thread(self.ps_get_init_data_lock, node_id)
+        if self.use_threads:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.ps_get_init_data_lock, node_id)
+        else:
+            return self.ps_get_init_data_lock(node_id)
 
     def ps_get_init_data_lock(self, node_id: PSNodeId) -> Any:
         """
@@ -280,17 +495,22 @@ class PSServer:
         """
         This method is called to create new data for the given node.
         This data is sent over the network to the node to be processed by that node.
-        Since this method may block it is run in a separate thread.
+        Since this method may block it is run in a separate thread (see executor).
+        If use_threads is switched off in the configuration, it is called directly instead.
         If there is no more data to process (=job is done) this method returns None.
         Otherwise it returns the new data to be processed by the node.
-        It's called from ps_handle_node() (NodeNeedsMoreData message).
+        It's called from ps_handle_need_data() (NodeNeedsMoreData message).
 
         :param node_id: The id of the node that receives the new data.
         :return: The new data for the given node.
         :rtype: Optional[Any]
         """
 
-        return await asyncio.to_thread(self.ps_get_new_data_lock, node_id)
+        if self.use_threads:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.ps_get_new_data_lock, node_id)
+        else:
+            return self.ps_get_new_data_lock(node_id)
 
     def ps_get_new_data_lock(self, node_id: PSNodeId) -> Optional[Any]:
         """
@@ -307,33 +527,45 @@ class PSServer:
         with self.lock:
             return self.ps_get_new_data(node_id)
 
-    async def ps_process_result_thread(self, node_id: PSNodeId, result: Any):
+    async def ps_process_result_thread(self, node_id: PSNodeId, result: Any) -> bool:
         """
         This method processes the data (result) from the given node.
         Usually the server will merge the data with its internal data.
-        Since this method may block it is run in a separate thread.
-        It's called from ps_handle_node() (NewResultFromNode message).
+        Since this method may block it is run in a separate thread (see executor).
+        If use_threads is switched off in the configuration, it is called directly instead.
+        It's called from ps_handle_result() (NewResultFromNode message).
 
         :param node_id: The id of the node that has processed the data and sent
                         the results back to the server.
         :param result: The processed data from the node.
+        :return: True if the job is done after this result, False otherwise.
+        :rtype: bool
         """
 
-        await asyncio.to_thread(self.ps_process_result_lock, node_id, result)
+        if self.use_threads:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.ps_process_result_lock, node_id, result)
+        else:
+            return self.ps_process_result_lock(node_id, result)
 
-    def ps_process_result_lock(self, node_id: PSNodeId, result: Any):
+    def ps_process_result_lock(self, node_id: PSNodeId, result: Any) -> bool:
         """
         This method locks the server data before processing the result from the node.
+        The job is checked with ps_is_job_done() while the lock is still held, since it
+        reads the same data.
         It may block and is run in a separate thread.
         It's called from ps_process_result_thread() (NewResultFromNode message).
 
         :param node_id: The id of the node that has processed the data and sent
                         the results back to the server.
         :param result: The processed data from the node.
+        :return: True if the job is done after this result, False otherwise.
+        :rtype: bool
         """
 
         with self.lock:
             self.ps_process_result(node_id, result)
+            return self.ps_is_job_done()
 
     def ps_is_job_done(self) -> bool:
         """
@@ -343,7 +575,9 @@ class PSServer:
         If the job is done it returns True and all the nodes are notyfied at their next
         connection to the server.
         Otherwise it returns False.
-        It's called from ps_main_loop().
+        It's called from ps_main_loop() and after every result from a node
+        (ps_process_result_lock()), so it should be fast. The server lock is held
+        during the call, like for the other user methods.
 
         :return: True if the job is finished, False otherwise.
         :rtype: Bool
@@ -368,6 +602,8 @@ class PSServer:
         node hasn't send the heartbeat message in time or at all.
         The user can keep track of the nodes and mark the data as "not taken" so that other
         nodes can process the data of this node. See the mandelbrot example on how this can be done.
+        The node has already been removed from the active nodes, so any further message from it
+        is answered with an error. The server lock is held during the call.
 
         :param node_id: The id of the node that has missed the heartbeat message.
         """
@@ -382,6 +618,8 @@ class PSServer:
         It returns the new data that has to be processed by the given node (node_id).
         If the job is done and no more data has to be processed then this method must
         return None.
+        After a lost connection the node asks again, so if the node has not sent back
+        the result of its current data yet, the same data should be returned again.
 
         :param node_id: The id of the node that receives the new data.
         :return: The new data for the given node.
@@ -397,6 +635,8 @@ class PSServer:
         ps_process_result_lock() (NewResultFromNode message).
         The node sends the processed data to the server and the user has to handle
         this processed result in this method. Usually it is merged in some data structure.
+        If the answer to the node got lost, the node sends the same result again after a reconnect,
+        so the result should carry enough information to detect that (see the mandelbrot example).
 
         :param node_id: The id of the node that has processed the data and sent the results back to
                         the server.
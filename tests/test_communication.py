@@ -5,15 +5,17 @@
 
 import unittest
 import asyncio
+import errno
 import logging
 import pathlib
 import time
-from typing import Optional, override
+from typing import Any, Optional, override
 
 from parasnake.ps_nodeid import PSNodeId
 from parasnake.ps_node import PSNode
 from parasnake.ps_server import PSServer
 from parasnake.ps_config import PSConfiguration
+import parasnake.ps_message as psm
 
 logger = logging.getLogger(__name__)
 
@@ -22,22 +24,27 @@ class WorkData:
     def __init__(self):
         self.value: int = 0
         self.assigned: bool = False
+        # How many results have been accepted for this job:
+        self.results: int = 0
 
 
 class TestNode(PSNode):
     def __init__(self, configuration: PSConfiguration):
         super().__init__(configuration)
         self.init_data: int = 0
+        self.process_time: float = 1.5
 
     @override
     def ps_init(self, data: int):
         self.init_data = data
 
     @override
-    def ps_process_data(self, data: int) -> int:
+    def ps_process_data(self, data: tuple[int, int]) -> tuple[int, int, int]:
         logger.debug(f"Process data: {data}")
-        time.sleep(1.5)
-        return data + 10
+        index, value = data
+        time.sleep(self.process_time)
+        # Send the old value back, so that the server can detect a result that was sent twice:
+        return (index, value, value + 10)
 
 
 class TestServer(PSServer):
@@ -46,6 +53,7 @@ class TestServer(PSServer):
         self.job_data: list[WorkData] = []
         self.active_nodes: dict[PSNodeId, int] = {}
         self.timeout_nodes: list[PSNodeId] = []
+        self.duplicate_results: int = 0
         self.max_value = 50
 
         for _ in range(10):
@@ -82,7 +90,7 @@ class TestServer(PSServer):
             del self.active_nodes[node_id]
 
     @override
-    def ps_get_new_data(self, node_id: PSNodeId) -> Optional[int]:
+    def ps_get_new_data(self, node_id: PSNodeId) -> Optional[tuple[int, int]]:
         if node_id in self.active_nodes:
             index = self.active_nodes[node_id]
             value = self.job_data[index].value
@@ -90,26 +98,121 @@ class TestServer(PSServer):
             logger.debug(f"Active node {node_id} found with index: {index} and value: {value}")
 
             if value < self.max_value:
-                return value
+                return (index, value)
 
         for i, jd in enumerate(self.job_data):
-            if not jd.assigned:
+            if not jd.assigned and jd.value < self.max_value:
                 logger.debug(f"New index assigned for node {node_id}: {i}, value: {jd.value}")
 
                 self.active_nodes[node_id] = i
                 jd.assigned = True
-                return jd.value
+                return (i, jd.value)
 
         # No more data to distribute.
         return None
 
     @override
-    def ps_process_result(self, node_id: PSNodeId, result: int):
-        if node_id in self.active_nodes:
-            logger.debug(f"Got result from active node: {node_id}, value: {result}")
+    def ps_process_result(self, node_id: PSNodeId, result: tuple[int, int, int]):
+        logger.debug(f"Got result from node: {node_id}, value: {result}")
+        index, old_value, new_value = result
+        jd = self.job_data[index]
 
-            index = self.active_nodes[node_id]
-            self.job_data[index].value = result
+        if jd.value == old_value:
+            jd.value = new_value
+            jd.results += 1
+        else:
+            # This result has already been processed.
+            self.duplicate_results += 1
+
+
+class SilentNode(TestNode):
+    """
+    Doesn't send any heartbeat, so the server times it out while it processes the data.
+    """
+
+    def __init__(self, configuration: PSConfiguration):
+        super().__init__(configuration)
+        self.init_count: int = 0
+
+    @override
+    def ps_init(self, data: int):
+        super().ps_init(data)
+        self.init_count += 1
+
+    @override
+    async def ps_send_heartbeat(self) -> None:
+        pass
+
+
+class UnreachableNode(TestNode):
+    """
+    The server host can't be reached the first time the node connects.
+    """
+
+    def __init__(self, configuration: PSConfiguration):
+        super().__init__(configuration)
+        self.unreachable: bool = True
+
+    @override
+    async def ps_open_connection(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self.unreachable:
+            self.unreachable = False
+            raise OSError(errno.EHOSTUNREACH, "No route to host")
+
+        return await super().ps_open_connection()
+
+
+class ConcurrencyServer(TestServer):
+    """
+    Records how many messages are handled at the same time.
+    """
+
+    def __init__(self, configuration: PSConfiguration):
+        super().__init__(configuration)
+        self.in_flight: int = 0
+        self.max_in_flight: int = 0
+
+    @override
+    async def ps_handle_message(self, writer: asyncio.StreamWriter, msg: Any):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            # Give the other node the chance to send a message in the meantime:
+            await asyncio.sleep(0.05)
+            await super().ps_handle_message(writer, msg)
+        finally:
+            self.in_flight -= 1
+
+
+class DropServer(TestServer):
+    """
+    Drops the connection after it has handled a result and the following NodeNeedsMoreData
+    message, before the node gets the answers. The node has to send both messages again.
+    """
+
+    def __init__(self, configuration: PSConfiguration):
+        super().__init__(configuration)
+        self.drop_writer: Optional[asyncio.StreamWriter] = None
+        self.dropped: bool = False
+
+    @override
+    async def ps_handle_message(self, writer: asyncio.StreamWriter, msg: Any):
+        if msg[0] == psm.PSMessageType.NewResultFromNode and not self.dropped:
+            self.drop_writer = writer
+
+        await super().ps_handle_message(writer, msg)
+
+        if msg[0] == psm.PSMessageType.NodeNeedsMoreData and writer is self.drop_writer:
+            self.drop_writer = None
+            self.dropped = True
+            writer.transport.abort()
+
+    @override
+    def ps_write_msg(self, writer, msg: bytes):
+        # The answers get lost:
+        if writer is not self.drop_writer:
+            super().ps_write_msg(writer, msg)
 
 
 class TestCommunication(unittest.IsolatedAsyncioTestCase):
@@ -222,6 +325,263 @@ class TestCommunication(unittest.IsolatedAsyncioTestCase):
             self.assertTrue(jd.assigned)
             self.assertEqual(jd.value, server.max_value)
 
+    async def test_resend_after_drop(self):
+        config = self.gen_config()
+        config.quit_counter = 1
+
+        logger.info("Start test case test_resend_after_drop")
+
+        server = DropServer(config)
+        node = TestNode(config)
+        node.process_time = 0.1
+
+        async with asyncio.TaskGroup() as tg:
+            server_task = tg.create_task(server.ps_main_loop())
+            server_task.set_name("ServerTask")
+
+            # Give the server some time to start up.
+            await asyncio.sleep(2.0)
+
+            node_task = tg.create_task(node.ps_start_tasks())
+            node_task.set_name("NodeTask")
+
+        self.assertTrue(server.dropped)
+        self.assertEqual(server.duplicate_results, 1)
+        self.assertEqual(len(server.timeout_nodes), 0)
+
+        for jd in server.job_data:
+            self.assertEqual(jd.results, 5)
+            self.assertEqual(jd.value, server.max_value)
+
+    async def test_reconnect_refused(self):
+        config = self.gen_config()
+
+        logger.info("Start test case test_reconnect_refused")
+
+        server = TestServer(config)
+        node = TestNode(config)
+
+        # Run the server's connection handler without its main loop, so that it can be restarted:
+        listener = await asyncio.start_server(server.ps_handle_node, config.server_address, config.server_port)
+
+        try:
+            answers = await node.ps_send_msgs_return_answers([node.init_message])
+            self.assertEqual(answers, [(psm.PSMessageType.InitOK, 10)])
+
+            # Simulate a server restart, the first reconnect attempt is refused:
+            listener.close()
+            for writer in list(server.node_writers):
+                writer.close()
+            await listener.wait_closed()
+
+            async def restart() -> asyncio.Server:
+                await asyncio.sleep(0.7)
+                return await asyncio.start_server(server.ps_handle_node, config.server_address, config.server_port)
+
+            restart_task = asyncio.create_task(restart())
+            answer = await node.ps_send_msg_return_answer(node.heartbeat_message)
+            listener = await restart_task
+
+            self.assertEqual(answer, psm.PSMessageType.HeartbeatOK)
+        finally:
+            await node.ps_close_connection()
+            listener.close()
+            await listener.wait_closed()
+            server.executor.shutdown()
+
+    async def test_timeout_register_again(self):
+        config = self.gen_config()
+        config.heartbeat_timeout = 1
+        config.quit_counter = 1
+
+        logger.info("Start test case test_timeout_register_again")
+
+        server = TestServer(config)
+        server.job_data = server.job_data[:4]
+        server.max_value = 10
+        node = SilentNode(config)
+        # Longer than twice the heartbeat timeout:
+        node.process_time = 2.5
+
+        async def check_heartbeat():
+            while not server_task.done():
+                server.ps_check_heartbeat()
+                await asyncio.sleep(0.5)
+
+        # A node that gives up would leave the server running forever:
+        async with asyncio.timeout(120), asyncio.TaskGroup() as tg:
+            server_task = tg.create_task(server.ps_main_loop())
+            server_task.set_name("ServerTask")
+            tg.create_task(check_heartbeat())
+
+            # Give the server some time to start up.
+            await asyncio.sleep(2.0)
+
+            node_task = tg.create_task(node.ps_start_tasks())
+            node_task.set_name("NodeTask")
+
+        # The node has been timed out and has registered again each time, without losing its results:
+        self.assertIn(node.node_id, server.timeout_nodes)
+        self.assertGreater(node.init_count, 1)
+
+        for jd in server.job_data:
+            self.assertEqual(jd.results, 1)
+            self.assertEqual(jd.value, server.max_value)
+
+    async def test_idle_connection(self):
+        config = self.gen_config()
+        config.heartbeat_timeout = 1
+
+        logger.info("Start test case test_idle_connection")
+
+        server = TestServer(config)
+        listener = await asyncio.start_server(server.ps_handle_node, config.server_address, config.server_port)
+
+        try:
+            # A connection that never sends anything:
+            reader, writer = await asyncio.open_connection(config.server_address, config.server_port)
+            start = time.monotonic()
+            data = await asyncio.wait_for(reader.read(), 10.0)
+            elapsed = time.monotonic() - start
+
+            # The server closes it after twice the heartbeat timeout:
+            self.assertEqual(data, b"")
+            self.assertGreater(elapsed, 1.5)
+            self.assertLess(elapsed, 5.0)
+
+            writer.close()
+            await writer.wait_closed()
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            server.executor.shutdown()
+
+        self.assertEqual(len(server.node_writers), 0)
+
+    async def test_max_concurrent(self):
+        config = self.gen_config()
+        config.max_concurrent = 1
+        config.quit_counter = 1
+
+        logger.info("Start test case test_max_concurrent")
+
+        server = ConcurrencyServer(config)
+        node1 = TestNode(config)
+        node2 = TestNode(config)
+        node1.process_time = 0.1
+        node2.process_time = 0.1
+
+        async with asyncio.TaskGroup() as tg:
+            server_task = tg.create_task(server.ps_main_loop())
+            server_task.set_name("ServerTask")
+
+            # Give the server some time to start up.
+            await asyncio.sleep(2.0)
+
+            node_task1 = tg.create_task(node1.ps_start_tasks())
+            node_task1.set_name("NodeTask1")
+
+            node_task2 = tg.create_task(node2.ps_start_tasks())
+            node_task2.set_name("NodeTask2")
+
+        self.assertEqual(server.max_in_flight, 1)
+
+        for jd in server.job_data:
+            self.assertEqual(jd.value, server.max_value)
+
+    async def test_shutdown_closes_connections(self):
+        config = self.gen_config()
+        config.quit_counter = 1
+
+        logger.info("Start test case test_shutdown_closes_connections")
+
+        server = TestServer(config)
+
+        # Nothing left to do:
+        for jd in server.job_data:
+            jd.value = server.max_value
+
+        server_task = asyncio.create_task(server.ps_main_loop())
+
+        # Give the server some time to start up.
+        await asyncio.sleep(2.0)
+
+        # A connection that is still open when the server shuts down, its read timeout is much longer:
+        reader, writer = await asyncio.open_connection(config.server_address, config.server_port)
+
+        async with asyncio.timeout(60):
+            await server_task
+            data = await reader.read()
+
+        self.assertEqual(data, b"")
+        self.assertEqual(len(server.node_writers), 0)
+
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_no_threads(self):
+        config = self.gen_config()
+        config.use_threads = False
+        config.quit_counter = 1
+
+        logger.info("Start test case test_no_threads")
+
+        server = TestServer(config)
+        node = TestNode(config)
+        node.process_time = 0.1
+
+        async with asyncio.TaskGroup() as tg:
+            server_task = tg.create_task(server.ps_main_loop())
+            server_task.set_name("ServerTask")
+
+            # Give the server some time to start up.
+            await asyncio.sleep(2.0)
+
+            node_task = tg.create_task(node.ps_start_tasks())
+            node_task.set_name("NodeTask")
+
+        self.assertEqual(node.init_data, 10)
+        self.assertEqual(len(server.timeout_nodes), 0)
+
+        for jd in server.job_data:
+            self.assertEqual(jd.results, 5)
+            self.assertEqual(jd.value, server.max_value)
+
+    async def test_reconnect_unreachable(self):
+        config = self.gen_config()
+
+        logger.info("Start test case test_reconnect_unreachable")
+
+        server = TestServer(config)
+        node = UnreachableNode(config)
+        listener = await asyncio.start_server(server.ps_handle_node, config.server_address, config.server_port)
+
+        try:
+            answers = await node.ps_send_msgs_return_answers([node.init_message])
+            self.assertFalse(node.unreachable)
+            self.assertEqual(answers, [(psm.PSMessageType.InitOK, 10)])
+        finally:
+            await node.ps_close_connection()
+            listener.close()
+            await listener.wait_closed()
+            server.executor.shutdown()
+
+    async def test_heartbeat_without_server(self):
+        config = self.gen_config()
+        config.heartbeat_timeout = 1
+
+        logger.info("Start test case test_heartbeat_without_server")
+
+        node = TestNode(config)
+
+        # There is no server, the heartbeat task keeps trying:
+        heartbeat_task = asyncio.create_task(node.ps_send_heartbeat())
+        await asyncio.sleep(2.0)
+        self.assertFalse(heartbeat_task.done())
+
+        heartbeat_task.cancel()
+        await asyncio.gather(heartbeat_task, return_exceptions=True)
+
 
 if __name__ == "__main__":
     log_file_name: str = "communication.log"
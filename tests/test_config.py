@@ -145,6 +145,95 @@ class TestConfiguration(unittest.TestCase):
             cfg: PSConfiguration = self.create_and_load_config(data)
             del cfg
 
+    def test_load_json5(self):
+        """
+        Test optional use_threads value.
+        """
+
+        data = """
+        {
+            "secret_key": "<key>",
+            "use_threads": false
+        }
+        """
+
+        secret_key = "aaaaaaaabbbbbbbbccccccccdddddddd"
+        data = data.replace("<key>", secret_key)
+
+        cfg: PSConfiguration = self.create_and_load_config(data)
+
+        self.assertFalse(cfg.use_threads)
+        self.assertTrue(PSConfiguration(secret_key).use_threads)
+
+    def test_load_json6(self):
+        """
+        Test optional worker_threads value.
+        """
+
+        data = """
+        {
+            "secret_key": "<key>",
+            "worker_threads": 4
+        }
+        """
+
+        secret_key = "aaaaaaaabbbbbbbbccccccccdddddddd"
+        data = data.replace("<key>", secret_key)
+
+        cfg: PSConfiguration = self.create_and_load_config(data)
+
+        self.assertEqual(cfg.worker_threads, 4)
+        self.assertEqual(PSConfiguration(secret_key).worker_threads, 1)
+
+        with self.assertRaises(AssertionError):
+            cfg = self.create_and_load_config(data.replace("4", "0"))
+
+    def test_load_json7(self):
+        """
+        Test optional max_concurrent value.
+        """
+
+        data = """
+        {
+            "secret_key": "<key>",
+            "max_concurrent": 16
+        }
+        """
+
+        secret_key = "aaaaaaaabbbbbbbbccccccccdddddddd"
+        data = data.replace("<key>", secret_key)
+
+        cfg: PSConfiguration = self.create_and_load_config(data)
+
+        self.assertEqual(cfg.max_concurrent, 16)
+        self.assertEqual(PSConfiguration(secret_key).max_concurrent, 256)
+
+        with self.assertRaises(AssertionError):
+            cfg = self.create_and_load_config(data.replace("16", "0"))
+
+    def test_load_json8(self):
+        """
+        Test optional socket_buffer_size value.
+        """
+
+        data = """
+        {
+            "secret_key": "<key>",
+            "socket_buffer_size": 262144
+        }
+        """
+
+        secret_key = "aaaaaaaabbbbbbbbccccccccdddddddd"
+        data = data.replace("<key>", secret_key)
+
+        cfg: PSConfiguration = self.create_and_load_config(data)
+
+        self.assertEqual(cfg.socket_buffer_size, 262144)
+        self.assertEqual(PSConfiguration(secret_key).socket_buffer_size, 0)
+
+        with self.assertRaises(AssertionError):
+            cfg = self.create_and_load_config(data.replace("262144", "-1"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -4,7 +4,12 @@
 # See: https://github.com/willi-kappler/parasnake
 
 import unittest
+import asyncio
 import base64
+import gc
+from unittest import mock
+
+from cryptography.exceptions import InvalidTag
 
 import parasnake.ps_message as psm
 from parasnake.ps_nodeid import PSNodeId
@@ -35,6 +40,39 @@ class TestMessage(unittest.TestCase):
 
         self.assertEqual(msg1, msg3)
 
+    def test_encode_decode3(self):
+        key = self.gen_key()
+
+        msg1 = ("This is test 3", list(range(psm.COMPRESSION_THRESHOLD)))
+        msg2 = psm.encode_message(msg1, key)
+        msg3 = psm.decode_message(msg2, key)
+
+        self.assertEqual(msg1, msg3)
+
+    def test_decode_wrong_key(self):
+        key1 = self.gen_key()
+        key2 = base64.urlsafe_b64encode(b"2222222255555555ccccccccllllllll")
+
+        msg1 = psm.encode_message("This is test 6", key1)
+
+        with self.assertRaises(InvalidTag):
+            psm.decode_message(msg1, key2)
+
+    def test_encode_decode_gc(self):
+        key = self.gen_key()
+
+        msg1 = psm.encode_message("This is test 4", key)
+        psm.decode_message(msg1, key)
+        self.assertTrue(gc.isenabled())
+
+        gc.disable()
+        try:
+            msg1 = psm.encode_message("This is test 4", key)
+            psm.decode_message(msg1, key)
+            self.assertFalse(gc.isenabled())
+        finally:
+            gc.enable()
+
     def test_heartbeat_message(self):
         id = PSNodeId()
         key = self.gen_key()
@@ -130,6 +168,64 @@ class TestMessage(unittest.TestCase):
 
         self.assertEqual(msg2, psm.PSMessageType.Quit)
 
+    def test_static_message_cache(self):
+        key = self.gen_key()
+
+        msg1 = psm.ps_gen_quit_message(key)
+        msg2 = psm.ps_gen_quit_message(key)
+
+        self.assertEqual(msg1, msg2)
+        self.assertEqual(psm.decode_message(msg2, key), psm.PSMessageType.Quit)
+
+    def test_node_message_cache(self):
+        id = PSNodeId()
+        key = self.gen_key()
+
+        msg1 = psm.ps_gen_need_more_data_message(id, key)
+        msg2 = psm.ps_gen_need_more_data_message(id, key)
+
+        # Only the plain text is cached, each message is encrypted again:
+        self.assertNotEqual(msg1, msg2)
+        self.assertEqual(psm.decode_message(msg1, key), psm.decode_message(msg2, key))
+
+    def test_frame_message(self):
+        async def read_all(data: bytes) -> list[bytes]:
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+
+            frames = [await psm.read_frame(reader), await psm.read_frame(reader)]
+
+            with self.assertRaises(asyncio.IncompleteReadError):
+                await psm.read_frame(reader)
+
+            return frames
+
+        msg1 = psm.frame_message(b"This is test 5") + psm.frame_message(b"")
+        msg2 = asyncio.run(read_all(msg1))
+
+        self.assertEqual(msg2, [b"This is test 5", b""])
+
+    def test_frame_message_too_big(self):
+        async def read_one(data: bytes) -> bytes:
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+
+            return await psm.read_frame(reader)
+
+        header = (psm.MAX_MSG_BYTES + 1).to_bytes(psm.FRAME_HEADER_SIZE, "big")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(read_one(header))
+
+    def test_frame_header_too_big(self):
+        with mock.patch.object(psm, "MAX_MSG_BYTES", 8):
+            self.assertEqual(psm.frame_header(b"12345678"), b"\x00\x00\x00\x08")
+
+            with self.assertRaises(ValueError):
+                psm.frame_header(b"123456789")
+
 
 if __name__ == "__main__":
     unittest.main()
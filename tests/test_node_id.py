@@ -5,6 +5,7 @@
 
 import unittest
 import copy
+import pickle
 import uuid
 
 from parasnake.ps_nodeid import PSNodeId
@@ -35,6 +36,12 @@ class TestNodeId(unittest.TestCase):
         self.assertEqual(d[id2], "node2")
         self.assertEqual(d[id3], "node3")
 
+    def test_uuid4(self):
+        id1 = PSNodeId()
+
+        self.assertEqual(id1.id.version, 4)
+        self.assertEqual(id1.id.variant, uuid.RFC_4122)
+
     def test_repr1(self):
         id1 = PSNodeId()
 
@@ -52,6 +59,16 @@ class TestNodeId(unittest.TestCase):
 
         self.assertEqual(s, "PSNodeId(11111111-cccc-cccc-5555-5555aaaaaaaa)")
 
+    def test_pickle(self):
+        id1 = PSNodeId()
+
+        s = pickle.dumps(id1, protocol=pickle.HIGHEST_PROTOCOL)
+        id2 = pickle.loads(s)
+
+        self.assertEqual(id1, id2)
+        self.assertEqual(hash(id1), hash(id2))
+        self.assertIn(id1.id.bytes, s)
+
 
 if __name__ == "__main__":
     unittest.main()